@@ -2,41 +2,131 @@
 """
 Invoice PDF generator (ReportLab).
 Reads invoice JSON from stdin and writes a single PDF provided via --output.
+With --batch, reads one invoice per line (NDJSON) and writes each PDF into --output-dir.
 """
 import argparse
+import functools
+import io
 import json
+import mmap
+import os
+import re
 import sys
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from xml.sax.saxutils import escape
 
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
 from reportlab.lib.units import mm
+from reportlab.lib.utils import simpleSplit
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+from reportlab.platypus import BaseDocTemplate, Flowable, Frame, PageTemplate, Paragraph, Spacer, Table, TableStyle
+
+try:
+    # Optional: orjson parses bytes faster than the stdlib; fall back when missing.
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Generate a PDF invoice from JSON input (stdin)")
-    parser.add_argument("--output", required=True, help="Path to the PDF file to create")
-    return parser.parse_args()
+    parser.add_argument("--output", help="Path to the PDF file to create")
+    parser.add_argument("--batch", action="store_true", help="Read one invoice per line and render each of them")
+    parser.add_argument("--output-dir", help="Directory for the PDFs created in --batch mode")
+    args = parser.parse_args()
+    if args.batch and not args.output_dir:
+        parser.error("--output-dir is required with --batch")
+    if not args.batch and not args.output:
+        parser.error("--output is required")
+    return args
+
+
+def _safe_name(value):
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", str(value or "")).strip("_")
 
 
-def fmt_money(value):
+def batch_file_name(inv, index):
+    # Same shape as the server's file names: <sanitized number>_<sanitized id>.pdf
+    base = _safe_name(inv.get("invoiceNumber") or inv.get("id")) or "invoice"
+    return f"{base}_{_safe_name(inv.get('id')) or index}.pdf"
+
+
+def _money(value, currency, _fmt="{:.2f}".format):
     try:
-        return f"{float(value):.2f}"
-    except Exception:
-        return "0.00"
+        amount = _fmt(float(value))
+    except (TypeError, ValueError):
+        amount = "0.00"
+    return f"{amount} {currency}" if currency else amount
+
+
+_FONT_NAME = None
+_FONT_MAP = None
+_GREY = colors.grey
+_LIGHTGREY = colors.lightgrey
+# Invoice layout is identical for every document; only the cell text changes.
+_HEADERS = ("#", "Item", "Quantity", "Unit price", "Net", "VAT %", "VAT", "Gross")
+_MARGIN = 18 * mm
+_PARTIES_COLWIDTHS = (90 * mm, 90 * mm)
+# Parties column minus the default 6pt left/right cell padding.
+_PARTY_LINE_WIDTH = _PARTIES_COLWIDTHS[0] - 12
+_ITEM_COLWIDTHS = (12 * mm, 55 * mm, 28 * mm, 28 * mm, 25 * mm, 18 * mm, 25 * mm, 28 * mm)
+_TOTALS_COLWIDTHS = (60 * mm, 40 * mm)
+_PARTIES_TABLE_STYLE = TableStyle(
+    [
+        ("VALIGN", (0, 0), (-1, -1), "TOP"),
+        ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+    ]
+)
+
+
+class _MappedFile:
+    # ReportLab keeps whatever read() returns as the font data; handing it the
+    # mmap itself lets the kernel page in only the tables that get touched.
+    def __init__(self, path, data):
+        self.name = path
+        self._data = data
+
+    def read(self):
+        return self._data
 
 
-def money_cell(value, currency):
-    amount = fmt_money(value)
-    return f"{amount} {currency}".strip()
+def _open_font(path):
+    global _FONT_MAP
+    with open(path, "rb") as fh:
+        _FONT_MAP = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    font = TTFont("CounterFont", _MappedFile(path, _FONT_MAP))
+    font.face.makeSubset = _cached_subsets(font.face.makeSubset)
+    return font
+
+
+def _cached_subsets(make_subset, limit=64):
+    # ReportLab rebuilds the embedded glyph subset for every document. ASCII sits
+    # at fixed codes (rl_config.ttfAsciiReadable), so invoices share subsets and
+    # the generated font program can be reused instead of rebuilt.
+    cache = {}
+
+    def make_cached(subset):
+        key = tuple(subset)
+        data = cache.get(key)
+        if data is None:
+            if len(cache) >= limit:
+                cache.clear()
+            data = cache[key] = make_subset(subset)
+        return data
+
+    return make_cached
 
 
 def register_font():
     # Try to load a font with extended glyph coverage; fall back to Helvetica.
+    # The result is cached so repeated builds skip the probe and TTF parse.
+    global _FONT_NAME
+    if _FONT_NAME is not None:
+        return _FONT_NAME
     candidates = [
         "/System/Library/Fonts/Supplemental/Arial.ttf",
         "/Library/Fonts/Arial.ttf",
@@ -44,72 +134,190 @@ def register_font():
         "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
     ]
     for path in candidates:
-        if Path(path).exists():
-            pdfmetrics.registerFont(TTFont("CounterFont", path))
-            return "CounterFont"
-    return "Helvetica"
+        if os.path.isfile(path):
+            if "CounterFont" not in pdfmetrics.getRegisteredFontNames():
+                pdfmetrics.registerFont(_open_font(path))
+            _FONT_NAME = "CounterFont"
+            return _FONT_NAME
+    _FONT_NAME = "Helvetica"
+    return _FONT_NAME
+
+
+@functools.lru_cache(maxsize=1)
+def _get_styles():
+    # The stylesheet is invariant across invoices, so build it once per process.
+    font_name = register_font()
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(name="Body", parent=styles["Normal"], fontName=font_name, fontSize=11, leading=14))
+    styles.add(ParagraphStyle(name="Heading", parent=styles["Heading4"], fontName=font_name, fontSize=12, leading=15))
+    styles.add(ParagraphStyle(name="CounterTitle", parent=styles["Title"], fontName=font_name, fontSize=16, leading=20))
+    return font_name, styles
+
+
+@functools.lru_cache(maxsize=1)
+def _get_table_styles():
+    # Table styles only depend on the resolved font; share them across invoices.
+    font_name = register_font()
+    lines_style = TableStyle(
+        [
+            ("FONTNAME", (0, 0), (-1, -1), font_name),
+            ("FONTSIZE", (0, 0), (-1, -1), 11),
+            ("LEADING", (0, 0), (-1, -1), 14),
+            ("LEFTPADDING", (0, 0), (-1, -1), 0),
+            ("RIGHTPADDING", (0, 0), (-1, -1), 0),
+            ("TOPPADDING", (0, 0), (-1, -1), 0),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 0),
+        ]
+    )
+    items_style = TableStyle(
+        [
+            ("FONTNAME", (0, 0), (-1, -1), font_name),
+            ("FONTSIZE", (0, 0), (-1, -1), 10),
+            ("GRID", (0, 0), (-1, -1), 0.5, _GREY),
+            ("BACKGROUND", (0, 0), (-1, 0), _LIGHTGREY),
+            ("ALIGN", (0, 0), (0, -1), "CENTER"),
+            ("ALIGN", (2, 0), (-1, -1), "RIGHT"),
+            ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+            ("TOPPADDING", (0, 0), (-1, -1), 6),
+        ]
+    )
+    totals_style = TableStyle(
+        [
+            ("FONTNAME", (0, 0), (-1, -1), font_name),
+            ("ALIGN", (1, 0), (-1, -1), "RIGHT"),
+            ("FONTSIZE", (0, 0), (-1, -1), 11),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+            ("TOPPADDING", (0, 0), (-1, -1), 6),
+        ]
+    )
+    return lines_style, items_style, totals_style
+
+
+class _InvoiceDocTemplate(BaseDocTemplate):
+    # Single A4 page template; every invoice fits the same frame, so the
+    # template is set up once and only the output target changes per build.
+    # Pages are always flate-compressed and the output is deterministic.
+    def __init__(self):
+        super().__init__(
+            None,
+            pagesize=A4,
+            leftMargin=_MARGIN,
+            rightMargin=_MARGIN,
+            topMargin=_MARGIN,
+            bottomMargin=_MARGIN,
+            pageCompression=1,
+            invariant=1,
+        )
+        frame = Frame(self.leftMargin, self.bottomMargin, self.width, self.height, id="normal")
+        self.addPageTemplates([PageTemplate(id="Invoice", frames=frame, pagesize=self.pagesize)])
+
+
+class _LineFlowable(Flowable):
+    # A single line of plain text, drawn straight onto the canvas without going
+    # through Paragraph's markup parser. Text wider than the frame falls back to
+    # an escaped Paragraph so it still wraps.
+    def __init__(self, text, style):
+        super().__init__()
+        self.text = text
+        self.style = style
+        self._para = None
+
+    def wrap(self, availWidth, availHeight):
+        style = self.style
+        if pdfmetrics.stringWidth(self.text, style.fontName, style.fontSize) <= availWidth:
+            self._para = None
+            return availWidth, style.leading
+        self._para = Paragraph(escape(self.text).replace("    ", " &nbsp;&nbsp; "), style)
+        return self._para.wrap(availWidth, availHeight)
+
+    def split(self, availWidth, availHeight):
+        # Only the Paragraph fallback can continue on the next page.
+        if self._para is not None:
+            return self._para.split(availWidth, availHeight)
+        return []
+
+    def draw(self):
+        if self._para is not None:
+            self._para.drawOn(self.canv, 0, 0)
+            return
+        style = self.style
+        self.canv.setFont(style.fontName, style.fontSize)
+        # Same baseline as a one-line Paragraph with this font size and leading.
+        self.canv.drawString(0, style.leading - style.fontSize, self.text)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_doc_template():
+    return _InvoiceDocTemplate()
+
+
+def _lines_table(lines, style, font_name):
+    # Plain-text party details: a one-column table skips Paragraph's XML parsing.
+    # Lines are pre-split to the parties column, which Paragraph used to wrap to.
+    rows = [[part] for line in lines for part in simpleSplit(line, font_name, 11, _PARTY_LINE_WIDTH)] or [[""]]
+    return Table(rows, colWidths=(_PARTY_LINE_WIDTH,), hAlign="LEFT", style=style)
 
 
 def build_items(inv):
     vat_percent = float(inv.get("vatPercent") or 0)
+    vat_factor = vat_percent / 100.0
     vat_label = f"{vat_percent:.0f}%"
     currency = inv.get("currency") or ""
     qty = float(inv.get("hours") or 0)
-    unit = inv.get("item", {}).get("unit") or "h"
-    desc = inv.get("item", {}).get("desc") or "Services"
+    item = inv.get("item") or {}
+    unit = item.get("unit") or "h"
+    desc = item.get("desc") or "Services"
     rate = float(inv.get("rate") or 0)
     net_value = float(inv.get("net") or 0)
     total_net = float(inv.get("totalNet") or net_value)
+    vat_amt_main = net_value * vat_factor
+    gross_main = net_value + vat_amt_main
 
     rows = [
         [
             "1",
             desc,
             f"{qty:.2f} {unit}",
-            money_cell(rate, currency),
-            money_cell(net_value, currency),
+            _money(rate, currency),
+            _money(net_value, currency),
             vat_label,
-            money_cell(net_value * vat_percent / 100, currency),
-            money_cell(net_value * (1 + vat_percent / 100), currency),
+            _money(vat_amt_main, currency),
+            _money(gross_main, currency),
         ]
     ]
 
     extra = inv.get("extra")
-    if extra and extra.get("desc"):
+    extra_desc = extra.get("desc") if extra else None
+    if extra_desc:
         extra_net = float(extra.get("net") or 0)
+        vat_amt_extra = extra_net * vat_factor
+        gross_extra = extra_net + vat_amt_extra
+        extra_net_cell = _money(extra_net, currency)
         rows.append(
             [
                 str(len(rows) + 1),
-                extra.get("desc"),
+                extra_desc,
                 "1 item",
-                money_cell(extra_net, currency),
-                money_cell(extra_net, currency),
+                extra_net_cell,
+                extra_net_cell,
                 vat_label,
-                money_cell(extra_net * vat_percent / 100, currency),
-                money_cell(extra_net * (1 + vat_percent / 100), currency),
+                _money(vat_amt_extra, currency),
+                _money(gross_extra, currency),
             ]
         )
 
-    gross_amount = float(inv.get("gross") or (total_net * (1 + vat_percent / 100)))
-    vat_amount = float(inv.get("vatAmount") or (total_net * vat_percent / 100))
+    gross_amount = float(inv.get("gross") or (total_net * (1 + vat_factor)))
+    vat_amount = float(inv.get("vatAmount") or (total_net * vat_factor))
     return rows, vat_label, currency, total_net, vat_amount, gross_amount
 
 
 def build_pdf(inv, output_path):
-    doc = SimpleDocTemplate(
-        output_path,
-        pagesize=A4,
-        leftMargin=18 * mm,
-        rightMargin=18 * mm,
-        topMargin=18 * mm,
-        bottomMargin=18 * mm,
-    )
-
-    font_name = register_font()
-    styles = getSampleStyleSheet()
-    styles.add(ParagraphStyle(name="Body", parent=styles["Normal"], fontName=font_name, fontSize=11, leading=14))
-    styles.add(ParagraphStyle(name="Heading", parent=styles["Heading4"], fontName=font_name, fontSize=12, leading=15))
-    styles.add(ParagraphStyle(name="CounterTitle", parent=styles["Title"], fontName=font_name, fontSize=16, leading=20))
+    # Render into memory and persist with a single write once the build succeeds.
+    buf = io.BytesIO()
+    doc = _get_doc_template()
+    font_name, styles = _get_styles()
+    lines_style, items_style, totals_style = _get_table_styles()
     story = []
 
     invoice_no = inv.get("invoiceNumber") or "Invoice"
@@ -120,113 +328,147 @@ def build_pdf(inv, output_path):
     sale_date = inv.get("saleDate") or ""
     due_date = inv.get("dueDate") or ""
     place = inv.get("place") or ""
-    meta = f"Issued: {issue_date} &nbsp;&nbsp; Sale date: {sale_date} &nbsp;&nbsp; Due: {due_date} &nbsp;&nbsp; Place: {place}"
-    story.append(Paragraph(meta, styles["Body"]))
+    meta = f"Issued: {issue_date}    Sale date: {sale_date}    Due: {due_date}    Place: {place}"
+    story.append(_LineFlowable(meta, styles["Body"]))
     story.append(Spacer(1, 10))
 
     seller = inv.get("seller") or {}
     buyer = inv.get("buyer") or {}
+    seller_tax = seller.get("taxId")
+    seller_account = seller.get("account")
+    seller_bank = seller.get("bank")
+    buyer_tax = buyer.get("taxId")
+    seller_lines = [
+        line
+        for line in (
+            seller.get("name", ""),
+            seller.get("address", ""),
+            seller.get("city", ""),
+            f"Tax ID: {seller_tax}" if seller_tax else "",
+            f"Account: {seller_account}" if seller_account else "",
+            f"Bank: {seller_bank}" if seller_bank else "",
+        )
+        if line
+    ]
+    buyer_lines = [
+        line
+        for line in (
+            buyer.get("name", ""),
+            buyer.get("address", ""),
+            buyer.get("city", ""),
+            f"Tax ID: {buyer_tax}" if buyer_tax else "",
+        )
+        if line
+    ]
     parties = [
         [Paragraph("<b>Seller</b>", styles["Heading"]), Paragraph("<b>Buyer</b>", styles["Heading"])],
         [
-            Paragraph(
-                "<br/>".join(
-                    filter(
-                        None,
-                        [
-                            seller.get("name", ""),
-                            seller.get("address", ""),
-                            seller.get("city", ""),
-                            f"Tax ID: {seller.get('taxId', '')}" if seller.get("taxId") else "",
-                            f"Account: {seller.get('account', '')}" if seller.get("account") else "",
-                            f"Bank: {seller.get('bank', '')}" if seller.get("bank") else "",
-                        ],
-                    )
-                ),
-                styles["Body"],
-            ),
-            Paragraph(
-                "<br/>".join(
-                    filter(
-                        None,
-                        [
-                            buyer.get("name", ""),
-                            buyer.get("address", ""),
-                            buyer.get("city", ""),
-                            f"Tax ID: {buyer.get('taxId', '')}" if buyer.get("taxId") else "",
-                        ],
-                    )
-                ),
-                styles["Body"],
-            ),
+            _lines_table(seller_lines, lines_style, font_name),
+            _lines_table(buyer_lines, lines_style, font_name),
         ],
     ]
-    parties_table = Table(parties, colWidths=[90 * mm, 90 * mm])
-    parties_table.setStyle(
-        TableStyle(
-            [
-                ("VALIGN", (0, 0), (-1, -1), "TOP"),
-                ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
-            ]
-        )
-    )
+    parties_table = Table(parties, colWidths=_PARTIES_COLWIDTHS)
+    parties_table.setStyle(_PARTIES_TABLE_STYLE)
     story.append(parties_table)
     story.append(Spacer(1, 12))
 
     items, vat_label, currency, total_net, vat_amount, gross_amount = build_items(inv)
-    headers = ["#", "Item", "Quantity", "Unit price", "Net", "VAT %", "VAT", "Gross"]
-    table_data = [headers] + items
-    items_table = Table(
-        table_data,
-        colWidths=[12 * mm, 55 * mm, 28 * mm, 28 * mm, 25 * mm, 18 * mm, 25 * mm, 28 * mm],
-    )
-    items_table.setStyle(
-        TableStyle(
-            [
-                ("FONTNAME", (0, 0), (-1, -1), font_name),
-                ("FONTSIZE", (0, 0), (-1, -1), 10),
-                ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-                ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
-                ("ALIGN", (0, 0), (0, -1), "CENTER"),
-                ("ALIGN", (2, 0), (-1, -1), "RIGHT"),
-                ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-                ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
-                ("TOPPADDING", (0, 0), (-1, -1), 6),
-            ]
-        )
-    )
+    items_table = Table([_HEADERS, *items], colWidths=_ITEM_COLWIDTHS)
+    items_table.setStyle(items_style)
     story.append(items_table)
     story.append(Spacer(1, 10))
 
     totals_table = Table(
         [
-            ["Net total:", money_cell(total_net, currency)],
-            [f"VAT {vat_label}:", money_cell(vat_amount, currency)],
-            ["Amount due:", money_cell(gross_amount, currency)],
+            ["Net total:", _money(total_net, currency)],
+            [f"VAT {vat_label}:", _money(vat_amount, currency)],
+            ["Amount due:", _money(gross_amount, currency)],
         ],
-        colWidths=[60 * mm, 40 * mm],
+        colWidths=_TOTALS_COLWIDTHS,
         hAlign="RIGHT",
     )
-    totals_table.setStyle(
-        TableStyle(
-            [
-                ("FONTNAME", (0, 0), (-1, -1), font_name),
-                ("ALIGN", (1, 0), (-1, -1), "RIGHT"),
-                ("FONTSIZE", (0, 0), (-1, -1), 11),
-                ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
-                ("TOPPADDING", (0, 0), (-1, -1), 6),
-            ]
-        )
-    )
+    totals_table.setStyle(totals_style)
     story.append(totals_table)
 
-    doc.build(story)
+    try:
+        doc.build(story, filename=buf)
+    finally:
+        # The shared template would otherwise keep this invoice's buffer and canvas alive.
+        doc.filename = None
+        doc.canv = None
+    with open(output_path, "wb") as fh:
+        fh.write(buf.getvalue())
+
+
+def _warm_up():
+    _get_styles()
+    _get_table_styles()
+
+
+def _render_one(task):
+    index, invoice, output_path = task
+    try:
+        build_pdf(invoice, output_path)
+    except Exception as exc:
+        return f"Failed to generate PDF for line {index}: {exc}"
+    return None
+
+
+def run_batch(output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    errors = []
+    tasks = []
+    used_names = set()
+    for index, line in enumerate(sys.stdin.buffer, start=1):
+        if not line.strip():
+            continue
+        try:
+            invoice = _loads(line)
+        except Exception as exc:
+            errors.append((index, f"Could not read JSON from line {index}: {exc}"))
+            continue
+        if not isinstance(invoice, dict):
+            errors.append((index, f"Could not read JSON from line {index}: expected an object"))
+            continue
+        name = batch_file_name(invoice, index)
+        while name in used_names:
+            # Same number and id on several lines: keep every PDF apart by line index.
+            name = f"{name[:-4]}_{index}.pdf"
+        used_names.add(name)
+        tasks.append((index, invoice, os.path.join(output_dir, name)))
+
+    # Invoices are independent and CPU-bound; small batches are not worth the pool start-up.
+    broken = None
+    if len(tasks) < 4:
+        results = list(map(_render_one, tasks))
+    else:
+        workers = min(os.cpu_count() or 1, len(tasks))
+        chunksize = max(1, min(8, len(tasks) // workers))
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_warm_up) as pool:
+                results = list(pool.map(_render_one, tasks, chunksize=chunksize))
+        except BrokenProcessPool as exc:
+            results = []
+            broken = f"Failed to generate PDF: {exc}"
+    errors.extend((task[0], error) for task, error in zip(tasks, results) if error)
+
+    # Report parse and render errors together, in input order.
+    errors.sort(key=lambda item: item[0])
+    for _, error in errors:
+        sys.stderr.write(error + "\n")
+    if broken:
+        sys.stderr.write(broken + "\n")
+        return len(errors) + 1
+    return len(errors)
 
 
 def main():
     args = parse_args()
+    if args.batch:
+        sys.exit(1 if run_batch(args.output_dir) else 0)
+
     try:
-        invoice = json.load(sys.stdin)
+        invoice = _loads(sys.stdin.buffer.read())
     except Exception as exc:
         sys.stderr.write(f"Could not read JSON from stdin: {exc}\n")
         sys.exit(1)